@@ -154,7 +154,7 @@ def _validate_classes(datamodule: LightningDataModule, model: LightningModule) -
     """
     data_test_classes = datamodule.get_current_task_class_names()
     datamodule_classes = datamodule.current_task_classes
-    model_trained_classes = model.current_task_classes
+    model_trained_classes = model.current_task_classes.tolist()
 
     log.info(f"Data test classes: {data_test_classes}")
     log.info(f"Data datamodule classes: {datamodule_classes}")
@@ -74,21 +74,23 @@ def quaternion_geodesic_loss(
 
 
 def masked_cross_entropy_loss(
-    logits: torch.Tensor, targets: torch.Tensor, valid_class_indices: torch.Tensor
+    logits: torch.Tensor, targets: torch.Tensor, invalid_class_mask: torch.Tensor
 ) -> torch.Tensor:
     """Compute masked cross-entropy loss for continual learning.
 
-    This function calculates the cross-entropy loss only for valid classes specified by
-    valid_class_indices. It masks out invalid classes by setting their logits to a very
-    negative value before applying softmax. This is a global mask, i.e. there is no
-    granularity in the form of different masks for different members of the batch.
+    This function calculates the cross-entropy loss only over valid classes. It masks out the
+    invalid classes given by invalid_class_mask by setting their logits to a very negative value
+    before applying softmax. The value is finite, so targets in masked classes (e.g. unseen
+    classes in the validation and test sets) give a large but finite loss. This is a global mask,
+    i.e. there is no granularity in the form of different masks for different members of the
+    batch.
 
     Args:
         logits (torch.Tensor): Predicted logits of shape (N, C) where C is the total number of
             classes
         targets (torch.Tensor): Target class indices of shape (N)
-        valid_class_indices (torch.Tensor): Tensor of valid class indices to include in loss
-            calculation
+        invalid_class_mask (torch.Tensor): Boolean tensor of shape (C) that is True for classes
+            to exclude from the loss calculation
 
     Returns:
         torch.Tensor: Masked cross-entropy loss
@@ -101,17 +103,13 @@ def masked_cross_entropy_loss(
     assert len(targets) == logits.shape[0], (
         f"Batch size mismatch: logits {logits.shape[0]} vs targets {len(targets)}"
     )
+    assert invalid_class_mask.shape == (logits.shape[1],), (
+        f"Mask shape mismatch: logits {logits.shape[1]} classes vs mask "
+        f"{tuple(invalid_class_mask.shape)}"
+    )
 
-    # Create a mask for valid classes
-    num_classes = logits.shape[1]
-    mask = torch.zeros(num_classes, dtype=torch.bool, device=logits.device)
-    mask[valid_class_indices] = True
-
-    # Create masked logits by setting invalid class logits to a large negative value
-    masked_logits = logits.clone()
-    masked_logits[:, ~mask] = -1e10
-
-    # Compute cross-entropy loss with the masked logits
-    loss = F.cross_entropy(masked_logits, targets)
+    # Set invalid class logits to a large negative value; F.cross_entropy fuses log-softmax
+    # and NLL
+    masked_logits = logits.masked_fill(invalid_class_mask, -1e10)
 
-    return loss
+    return F.cross_entropy(masked_logits, targets)
@@ -42,6 +42,7 @@ class ViTRgbdObjectClassifierWithRotation(nn.Module):
         use_pretrained: bool = True,
     ) -> None:
         super().__init__()
+        self.num_classes = num_classes
         model_id = MODEL_DICT[model_name]
         config = AutoConfig.from_pretrained(model_id)
         config.num_channels = 4
@@ -43,16 +43,19 @@ from typing import Any, Dict, Optional, Tuple, TypeAlias
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 import torchmetrics
 from lightning import LightningModule
 from torchmetrics import Accuracy, MeanMetric
 
 from src.losses.loss import masked_cross_entropy_loss, quaternion_geodesic_loss
-from src.metrics.continual_accuracy import calculate_continual_accuracy
 from src.metrics.rotation_error import get_rotation_error_in_degrees
+from src.utils import RankedLogger
 from src.utils.continual_learning_utils import compute_class_ranges
 
+log = RankedLogger(__name__, rank_zero_only=True)
+
 # Type aliases
 BatchDict: TypeAlias = Dict[str, torch.Tensor]
 ModelOutput: TypeAlias = Tuple[
@@ -82,6 +85,8 @@ class ContinualViTLitModule(LightningModule):
         compile: bool,
         task_id: int,
         num_classes_for_task: Optional[int] = None,
+        bf16_autocast: bool = False,
+        scheduler_total_steps: Optional[int] = 1400,
     ) -> None:
         """Initialize a ContinualViTLitModule.
 
@@ -94,6 +99,11 @@ class ContinualViTLitModule(LightningModule):
             task_id: Current task identifier for continual learning.
             num_classes_for_task: Number of classes in the current task. If None, uses default
                 class ranges.
+            bf16_autocast: Whether to run the forward pass under bfloat16 autocast on CUDA
+                devices that support it. Independent of the trainer's precision setting.
+            scheduler_total_steps: Number of steps of the learning rate schedule. Defaults to
+                1400 (200 epochs * 7 steps/epoch, as used in the hyperparameter search). If None,
+                uses the trainer's estimated number of stepping batches.
         """
         super().__init__()
         # this line allows to access init params with 'self.hparams' attribute
@@ -102,6 +112,9 @@ class ContinualViTLitModule(LightningModule):
 
         self.net = net
         self.task_id = task_id
+        self.num_classes = net.num_classes
+        # Resolved once in `setup` from `bf16_autocast` and the trainer's device
+        self._use_bf16_autocast = False
 
         self.classification_loss = masked_cross_entropy_loss
         self.quaternion_geodesic_loss = quaternion_geodesic_loss
@@ -110,11 +123,35 @@ class ContinualViTLitModule(LightningModule):
         self.train_metrics = self.create_metrics("train")
         self.val_metrics = self.create_metrics("val")
         self.test_metrics = self.create_metrics("test")
+        self._metrics_by_prefix = {
+            "train": self.train_metrics,
+            "val": self.val_metrics,
+            "test": self.test_metrics,
+        }
 
-        # Compute class ranges for continual learning
-        _, _, self.current_task_classes, self.all_seen_classes = compute_class_ranges(
+        # Compute class ranges for continual learning. These are registered as buffers so
+        # they follow the module onto its device.
+        _, _, current_task_classes, all_seen_classes = compute_class_ranges(
             num_classes_for_task, task_id
         )
+        self.register_buffer(
+            "current_task_classes",
+            torch.as_tensor(current_task_classes, dtype=torch.long),
+            persistent=False,
+        )
+        self.register_buffer(
+            "all_seen_classes",
+            torch.as_tensor(all_seen_classes, dtype=torch.long),
+            persistent=False,
+        )
+
+        # Always use all_seen_classes for valid classes
+        # This is a form of forward masking that ensures the model does not try to predict
+        # classes it has not seen yet. By restricting predictions to only seen classes,
+        # we prevent the model from making predictions on future/unseen classes during training.
+        invalid_class_mask = torch.ones(self.num_classes, dtype=torch.bool)
+        invalid_class_mask[all_seen_classes] = False
+        self.register_buffer("invalid_class_mask", invalid_class_mask, persistent=False)
 
     def create_metrics(self, prefix: str) -> MetricsDict:
         """Create metric objects for tracking model performance.
@@ -129,13 +166,13 @@ class ContinualViTLitModule(LightningModule):
             f"{prefix}/loss": MeanMetric(),
             f"{prefix}/classification_loss": MeanMetric(),
             f"{prefix}/quaternion_geodesic_loss": MeanMetric(),
-            f"{prefix}/class_acc": Accuracy(task="multiclass", num_classes=77),
+            f"{prefix}/class_acc": Accuracy(task="multiclass", num_classes=self.num_classes),
             f"{prefix}/rotation_error": MeanMetric(),
             f"{prefix}/all_seen_class_acc": MeanMetric(),
             f"{prefix}/current_task_class_acc": MeanMetric(),
         }
 
-        # Register metrics as attributes
+        # Register metrics as attributes so Lightning moves them to the module's device
         for name, metric in metrics.items():
             setattr(self, name.replace("/", "_"), metric)
 
@@ -154,6 +191,28 @@ class ContinualViTLitModule(LightningModule):
         """
         return self.net(x)
 
+    def _autocast_forward(self, x: torch.Tensor) -> ModelOutput:
+        """Forward pass, optionally under bfloat16 autocast.
+
+        When bfloat16 autocast is enabled, the outputs are cast back to float32 so the losses
+        (in particular the acos in the quaternion geodesic loss) and metrics are computed at
+        full precision.
+
+        Args:
+            x: Input tensor containing RGBD images
+
+        Returns:
+            Tuple containing:
+                pred_class: Class prediction logits
+                pred_quaternion: Quaternion prediction tensor
+        """
+        if not self._use_bf16_autocast:
+            return self.forward(x)
+
+        with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+            pred_class, pred_quaternion = self.forward(x)
+        return pred_class.float(), pred_quaternion.float()
+
     def model_step(self, batch: BatchDict) -> ModelStepOutput:
         """Perform a single model step on a batch of data.
 
@@ -175,19 +234,15 @@ class ContinualViTLitModule(LightningModule):
                 - unit_quaternion: Ground truth rotation quaternions of shape (batch_size, 4)
         """
         rgbd_image, object_ids, unit_quaternion = (
-            batch["rgbd_image"],
+            batch["rgbd_image"].to(memory_format=torch.channels_last),
             batch["object_ids"],
             batch["unit_quaternion"],
         )
-        pred_class, pred_quaternion = self.forward(rgbd_image)
-
-        # Always use all_seen_classes for valid classes
-        # This is a form of forward masking that ensures the model does not try to predict
-        # classes it has not seen yet. By restricting predictions to only seen classes,
-        # we prevent the model from making predictions on future/unseen classes during training.
-        valid_classes = self.all_seen_classes
+        pred_class, pred_quaternion = self._autocast_forward(rgbd_image)
 
-        classification_loss = self.classification_loss(pred_class, object_ids, valid_classes)
+        classification_loss = self.classification_loss(
+            pred_class, object_ids, self.invalid_class_mask
+        )
         quat_geodesic_loss = self.quaternion_geodesic_loss(pred_quaternion, unit_quaternion)
         loss = classification_loss + self.hparams.rotation_weight * quat_geodesic_loss
 
@@ -201,6 +256,43 @@ class ContinualViTLitModule(LightningModule):
             unit_quaternion,
         )
 
+    @staticmethod
+    def _compute_acc_tensors(
+        pred_class: torch.Tensor,
+        object_ids: torch.Tensor,
+        current_task_classes: torch.Tensor,
+        all_seen_classes: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Compute the current task and all seen classes accuracies for a batch.
+
+        This is a tensor-only equivalent of `calculate_continual_accuracy` without host syncs or
+        data-dependent branches, so it can be compiled without graph breaks.
+
+        Args:
+            pred_class: Class prediction logits of shape (batch_size, num_classes)
+            object_ids: Ground truth object class IDs of shape (batch_size,)
+            current_task_classes: Class indices of the current task
+            all_seen_classes: Class indices of all tasks seen so far
+
+        Returns:
+            Tuple containing:
+                - current_task_acc: Accuracy on samples from the current task classes
+                - all_seen_acc: Accuracy on samples from all seen classes
+        """
+        pred_indices = torch.argmax(pred_class, dim=1)
+        correct = pred_indices == object_ids
+
+        # Accuracy is 0 if no samples in the batch belong to the class subset
+        current_task_mask = torch.isin(object_ids, current_task_classes)
+        current_task_acc = (correct & current_task_mask).sum() / current_task_mask.sum().clamp(
+            min=1
+        )
+
+        all_seen_mask = torch.isin(object_ids, all_seen_classes)
+        all_seen_acc = (correct & all_seen_mask).sum() / all_seen_mask.sum().clamp(min=1)
+
+        return current_task_acc, all_seen_acc
+
     def log_metrics(
         self,
         prefix: str,
@@ -224,45 +316,36 @@ class ContinualViTLitModule(LightningModule):
             object_ids: Ground truth object class IDs of shape (batch_size,)
             unit_quaternion: Ground truth rotation quaternions of shape (batch_size, 4)
         """
-        metrics = (
-            self.train_metrics
-            if prefix == "train"
-            else self.val_metrics
-            if prefix == "val"
-            else self.test_metrics
-        )
+        metrics = self._metrics_by_prefix[prefix]
 
         rotation_errors = get_rotation_error_in_degrees(
             pred_quaternion, unit_quaternion
         )
 
-        # Get predicted class indices
-        pred_indices = torch.argmax(pred_class, dim=1)
-
-        # Calculate accuracy for current task classes
-        current_task_acc = calculate_continual_accuracy(
-            pred_indices, object_ids, self.current_task_classes
+        # Calculate accuracy for current task classes and all seen classes
+        current_task_acc, all_seen_acc = self._compute_acc_tensors(
+            pred_class, object_ids, self.current_task_classes, self.all_seen_classes
         )
 
-        # Calculate accuracy for all seen classes
-        all_seen_acc = calculate_continual_accuracy(
-            pred_indices, object_ids, self.all_seen_classes
-        )
-
-        # Move metrics to the correct device
-        for metric in metrics.values():
-            metric.to(self.device)
-
-        # Update metrics with current batch values
-        metrics[f"{prefix}/loss"].update(loss)
-        metrics[f"{prefix}/classification_loss"].update(classification_loss)
-        metrics[f"{prefix}/quaternion_geodesic_loss"].update(quaternion_geodesic_loss)
+        # Update metrics with current batch values. Values are detached so the running means
+        # never hold on to the autograd graph.
+        metrics[f"{prefix}/loss"].update(loss.detach())
+        metrics[f"{prefix}/classification_loss"].update(classification_loss.detach())
+        metrics[f"{prefix}/quaternion_geodesic_loss"].update(quaternion_geodesic_loss.detach())
         metrics[f"{prefix}/class_acc"].update(pred_class, object_ids)
-        metrics[f"{prefix}/rotation_error"].update(rotation_errors)
-        metrics[f"{prefix}/current_task_class_acc"].update(current_task_acc)
-        metrics[f"{prefix}/all_seen_class_acc"].update(all_seen_acc)
-
-        self.log_dict(metrics, on_step=False, on_epoch=True, prog_bar=True)
+        metrics[f"{prefix}/rotation_error"].update(rotation_errors.detach())
+        metrics[f"{prefix}/current_task_class_acc"].update(current_task_acc.detach())
+        metrics[f"{prefix}/all_seen_class_acc"].update(all_seen_acc.detach())
+
+        # Only the loss is shown in the progress bar; the remaining metrics are only logged
+        loss_name = f"{prefix}/loss"
+        self.log(loss_name, metrics[loss_name], on_step=False, on_epoch=True, prog_bar=True)
+        self.log_dict(
+            {name: metric for name, metric in metrics.items() if name != loss_name},
+            on_step=False,
+            on_epoch=True,
+            prog_bar=False,
+        )
 
     def training_step(self, batch: BatchDict, batch_idx: int) -> torch.Tensor:
         """Perform a single training step on a batch of data.
@@ -299,15 +382,6 @@ class ContinualViTLitModule(LightningModule):
         )
         return loss
 
-    def on_train_epoch_end(self) -> None:
-        """Reset training metrics at the end of each training epoch.
-
-        This method is called automatically by PyTorch Lightning after each training epoch to
-        ensure metrics are properly reset for the next epoch.
-        """
-        for metric in self.train_metrics.values():
-            metric.reset()
-
     def validation_step(self, batch: BatchDict, batch_idx: int) -> None:
         """Perform a single validation step on a batch of data.
 
@@ -339,15 +413,6 @@ class ContinualViTLitModule(LightningModule):
             unit_quaternion,
         )
 
-    def on_validation_epoch_end(self) -> None:
-        """Reset validation metrics at the end of each validation epoch.
-
-        This method is called automatically by PyTorch Lightning after each validation epoch to
-        ensure metrics are properly reset for the next epoch.
-        """
-        for metric in self.val_metrics.values():
-            metric.reset()
-
     def test_step(self, batch: BatchDict, batch_idx: int) -> None:
         """Perform a single test step on a batch of data.
 
@@ -379,15 +444,7 @@ class ContinualViTLitModule(LightningModule):
             unit_quaternion,
         )
 
-    def on_test_epoch_end(self) -> None:
-        """Reset test metrics at the end of each test epoch.
-
-        This method is called automatically by PyTorch Lightning after each test epoch to ensure
-        metrics are properly reset for the next epoch.
-        """
-        for metric in self.test_metrics.values():
-            metric.reset()
-
+    @torch.inference_mode()
     def predict_step(self, batch: BatchDict, batch_idx: int) -> PredictOutput:
         """Perform a single prediction step on a batch of data.
 
@@ -408,14 +465,15 @@ class ContinualViTLitModule(LightningModule):
                 - unit_quaternion: Ground truth rotation quaternions of shape (batch_size, 4)
         """
         rgbd_image, object_ids, unit_quaternion = (
-            batch["rgbd_image"],
+            batch["rgbd_image"].to(memory_format=torch.channels_last),
             batch["object_ids"],
             batch["unit_quaternion"],
         )
-        pred_class, pred_quaternion = self.forward(rgbd_image)
+        pred_class, pred_quaternion = self._autocast_forward(rgbd_image)
 
-        # Convert logits to probabilities using softmax
-        class_probabilities = torch.softmax(pred_class, dim=1)
+        # Convert logits to probabilities using softmax. Computed in float32 so probabilities
+        # keep full precision when the forward pass runs in reduced precision.
+        class_probabilities = F.softmax(pred_class, dim=1, dtype=torch.float32)
 
         return {
             "class_probabilities": class_probabilities,
@@ -431,8 +489,40 @@ class ContinualViTLitModule(LightningModule):
             stage: The current stage ('fit', 'validate', 'test', or 'predict').
                   Can be None during initialization.
         """
+        self._use_bf16_autocast = self.hparams.bf16_autocast
+        if self._use_bf16_autocast and not (
+            self.trainer.strategy.root_device.type == "cuda" and torch.cuda.is_bf16_supported()
+        ):
+            log.warning(
+                "bfloat16 autocast requires a CUDA device with bfloat16 support. "
+                "Running the forward pass in the trainer's precision..."
+            )
+            self._use_bf16_autocast = False
+
         if self.hparams.compile and stage == "fit":
-            self.net = torch.compile(self.net)
+            if not hasattr(nn.Module, "compile") or not torch.cuda.is_available():
+                log.warning(
+                    "Module compilation requires PyTorch >= 2.2 and a CUDA device. "
+                    "Skipping compilation..."
+                )
+            else:
+                # Regional compilation: compile each transformer block individually rather
+                # than the whole network. All blocks share the same shapes, so the compiled
+                # artifact is reused across blocks, which keeps warmup short. The patch
+                # embedding and heads stay in eager mode. `reduce-overhead` uses CUDA graphs
+                # to cut per-kernel launch latency.
+                # `nn.Module.compile` is used rather than overwriting `block.forward`, since
+                # the compiled call is dropped when pickling and `self.net` is pickled into
+                # every checkpoint through the saved hyperparameters.
+                for block in self.net.vit.encoder.layer:
+                    block.compile(mode="reduce-overhead", dynamic=False)
+                # Default mode without CUDA graphs, as this helper sees several batch sizes
+                # (train, val/test and ragged last batches)
+                self._compute_acc_tensors = torch.compile(self._compute_acc_tensors)
+
+        # Store the 4D weights (i.e. the RGBD patch embedding conv) in channels_last layout,
+        # matching the layout of the input images in `model_step` and `predict_step`
+        self.net = self.net.to(memory_format=torch.channels_last)
 
     def configure_optimizers(self) -> OptimizerConfig:
         """Configure optimizers and learning rate schedulers.
@@ -449,8 +539,9 @@ class ContinualViTLitModule(LightningModule):
         optimizer = self.hparams.optimizer(params=self.trainer.model.parameters())
 
         if self.hparams.scheduler is not None:
-            # total_steps = self.trainer.estimated_stepping_batches
-            total_steps = 1400  # 200 epochs * 7 steps/epoch when we did hparam search
+            total_steps = self.hparams.scheduler_total_steps
+            if total_steps is None:
+                total_steps = self.trainer.estimated_stepping_batches
             warmup_steps = int(0.05 * total_steps)  # 5% of total steps
             scheduler = self.hparams.scheduler(
                 optimizer=optimizer,